@@ -12,6 +12,12 @@ from tutor import exceptions
 class EnvTests(unittest.TestCase):
     def setUp(self):
         env.Renderer.reset()
+        # Don't store compiled templates in the user cache directory
+        patcher = unittest.mock.patch.dict(
+            os.environ, {env.BYTECODE_CACHE_ENV_VAR_NAME: "0"}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_walk_templates(self):
         renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
@@ -25,6 +31,61 @@ class EnvTests(unittest.TestCase):
         self.assertIn(template_name, renderer.environment.loader.list_templates())
         self.assertNotIn(template_name, templates)
 
+    def test_iter_templates_in(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+        self.assertEqual(
+            ["kustomization.yml"], list(renderer.iter_templates_in("kustomization.yml"))
+        )
+        self.assertEqual([], list(renderer.iter_templates_in("doesnotexist/")))
+        k8s_templates = list(renderer.iter_templates_in("k8s/"))
+        self.assertIn("k8s/deployments.yml", k8s_templates)
+        self.assertTrue(all(t.startswith("k8s/") for t in k8s_templates))
+
+    def test_template_roots_precedence(self):
+        with tempfile.TemporaryDirectory() as root1:
+            with tempfile.TemporaryDirectory() as root2:
+                for root, content in [(root1, "root1"), (root2, "root2")]:
+                    with open(os.path.join(root, "template.txt"), "w") as f:
+                        f.write(content)
+                renderer = env.Renderer({}, [root1, root2])
+                self.assertEqual("root1", renderer.render_file("template.txt"))
+
+                # Templates created later are loaded from disk
+                with open(os.path.join(root2, "new.txt"), "w") as f:
+                    f.write("new")
+                self.assertEqual("new", renderer.render_file("new.txt"))
+
+    def test_iter_templates_with_prefixes(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+        templates = dict(
+            renderer.iter_templates_with_prefixes(("k8s/", env.VERSION_FILENAME))
+        )
+        self.assertEqual("k8s/", templates["k8s/deployments.yml"])
+        self.assertEqual(env.VERSION_FILENAME, templates[env.VERSION_FILENAME])
+        self.assertNotIn("local/docker-compose.yml", templates)
+
+    def test_is_part_of_env(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT], ignore_folders=["partials"])
+        self.assertTrue(renderer.is_part_of_env("apps/nginx/lms.conf"))
+        self.assertTrue(renderer.is_part_of_env("apps/mypartials/file"))
+        self.assertFalse(renderer.is_part_of_env("apps/partials/file"))
+        self.assertFalse(renderer.is_part_of_env("apps/.git/config"))
+        self.assertFalse(renderer.is_part_of_env("apps/.hidden"))
+        self.assertFalse(renderer.is_part_of_env("apps/module.pyc"))
+
+    def test_template_roots_with_broken_links(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "template.txt"), "w") as f:
+                f.write("content")
+            os.symlink("/nonexistent", os.path.join(templates_root, "broken"))
+            os.makedirs(os.path.join(templates_root, "folder"))
+            os.symlink("..", os.path.join(templates_root, "folder", "loop"))
+            renderer = env.Renderer({}, [templates_root])
+            self.assertEqual("content", renderer.render_file("template.txt"))
+            self.assertNotIn(
+                "folder/loop/template.txt", list(renderer.iter_templates_in())
+            )
+
     def test_is_binary_file(self):
         self.assertTrue(env.is_binary_file("/home/somefile.ico"))
 
@@ -33,17 +94,81 @@ class EnvTests(unittest.TestCase):
         path = renderer.find_path("local/docker-compose.yml")
         self.assertTrue(os.path.exists(path))
 
+    def test_bytecode_cache_disabled(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+        self.assertIsNone(renderer.environment.bytecode_cache)
+
+    def test_bytecode_cache_enabled(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with unittest.mock.patch.dict(
+                os.environ, {env.BYTECODE_CACHE_ENV_VAR_NAME: "1"}
+            ):
+                with unittest.mock.patch.object(
+                    env.appdirs, "user_cache_dir", return_value=cache_dir
+                ):
+                    renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+            self.assertIsInstance(
+                renderer.environment.bytecode_cache, env.jinja2.FileSystemBytecodeCache
+            )
+            self.assertTrue(
+                renderer.environment.bytecode_cache.directory.startswith(cache_dir)
+            )
+
     def test_pathjoin(self):
         self.assertEqual(
             "/tmp/env/target/dummy", env.pathjoin("/tmp", "target", "dummy")
         )
         self.assertEqual("/tmp/env/dummy", env.pathjoin("/tmp", "dummy"))
 
+    def test_current_version(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.assertEqual("0.0.0", env.current_version(root))
+            path = env.pathjoin(root, env.VERSION_FILENAME)
+            env.write_to("1.0.0\n", path)
+            os.utime(path, ns=(0, 0))
+            self.assertEqual("1.0.0", env.current_version(root))
+            env.write_to("2.0.0\n", path)
+            self.assertEqual("2.0.0", env.current_version(root))
+
     def test_render_str(self):
         self.assertEqual(
             "hello world", env.render_str({"name": "world"}, "hello {{ name }}")
         )
 
+    def test_render_str_compiled_once(self):
+        renderer = env.Renderer({"name": "world"}, [env.TEMPLATES_ROOT])
+        with unittest.mock.patch.object(
+            renderer.environment, "from_string", wraps=renderer.environment.from_string,
+        ) as mock_from_string:
+            self.assertEqual("hello world", renderer.render_str("hello {{ name }}"))
+            self.assertEqual("hello world", renderer.render_str("hello {{ name }}"))
+        mock_from_string.assert_called_once_with("hello {{ name }}")
+
+    def test_render_str_plain_text(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+        with unittest.mock.patch.object(
+            renderer.environment, "from_string"
+        ) as mock_from_string:
+            self.assertEqual("hello world", renderer.render_str("hello world"))
+            self.assertEqual("hello world", renderer.render_str("hello world\n"))
+        mock_from_string.assert_not_called()
+        self.assertEqual("hello world\n", renderer.render_str("hello world\n\n"))
+        self.assertEqual("hello\nworld", renderer.render_str("hello\r\nworld"))
+
+    def test_render_str_random_values_are_not_cached(self):
+        renderer = env.Renderer({}, [env.TEMPLATES_ROOT])
+        self.assertNotEqual(
+            renderer.render_str("{{ 24|random_string }}"),
+            renderer.render_str("{{ 24|random_string }}"),
+        )
+
+    def test_render_dict(self):
+        config = {"name": "world", "greeting": "hello {{ name }}", "port": 80}
+        env.render_dict(config)
+        self.assertEqual(
+            {"name": "world", "greeting": "hello world", "port": 80}, config
+        )
+
     def test_common_domain(self):
         self.assertEqual(
             "mydomain.com",
@@ -91,6 +216,143 @@ class EnvTests(unittest.TestCase):
                 with open(os.path.join(root, "env", "apps", "nginx", "lms.conf")) as f:
                     self.assertIn("ssl", f.read())
 
+    def test_write_to_unchanged_content(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "sub", "file.txt")
+            env.write_to("content", path)
+            os.utime(path, (0, 0))
+
+            env.write_to("content", path)
+            self.assertEqual(0, os.stat(path).st_mtime)
+
+            env.write_to("new content", path)
+            self.assertNotEqual(0, os.stat(path).st_mtime)
+            with open(path) as f:
+                self.assertEqual("new content", f.read())
+            self.assertEqual(["file.txt"], os.listdir(os.path.dirname(path)))
+
+    def test_stream_file(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "hello.txt"), "w") as f:
+                f.write("hello {{ name }}")
+            renderer = env.Renderer({"name": "world"}, [templates_root])
+            with tempfile.TemporaryDirectory() as root:
+                dst = os.path.join(root, "sub", "hello.txt")
+                renderer.stream_file("hello.txt", dst)
+                with open(dst) as f:
+                    self.assertEqual("hello world", f.read())
+                self.assertEqual(["hello.txt"], os.listdir(os.path.dirname(dst)))
+
+    @unittest.mock.patch.object(tutor_config.fmt, "echo")
+    def test_stream_file_missing_configuration(self, _):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "hello.txt"), "w") as f:
+                f.write("hello {{ name }}")
+            renderer = env.Renderer({}, [templates_root])
+            with tempfile.TemporaryDirectory() as root:
+                dst = os.path.join(root, "sub", "hello.txt")
+                self.assertRaises(
+                    exceptions.TutorError, renderer.stream_file, "hello.txt", dst
+                )
+                self.assertEqual([], os.listdir(os.path.dirname(dst)))
+
+    def test_save_templates_with_render_cache(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "hello.txt"), "w") as f:
+                f.write("hello {{ name }}")
+            with open(os.path.join(templates_root, "bye.txt"), "w") as f:
+                f.write("bye {{ other }}")
+            config = {"name": "world", "other": "world"}
+            renderer = env.Renderer(config, [templates_root])
+            with tempfile.TemporaryDirectory() as root:
+                root_env = env.base_dir(root)
+
+                def save():
+                    render_cache = env.RenderCache(root)
+                    with unittest.mock.patch.object(
+                        renderer, "stream_file", wraps=renderer.stream_file
+                    ) as mock_stream_file:
+                        env.save_templates(
+                            renderer,
+                            ["bye.txt", "hello.txt"],
+                            root_env,
+                            render_cache=render_cache,
+                        )
+                    render_cache.save()
+                    return sorted(c[0][0] for c in mock_stream_file.call_args_list)
+
+                self.assertEqual(["bye.txt", "hello.txt"], save())
+                self.assertEqual([], save())
+
+                # Only templates that refer to modified values are rendered again
+                config["name"] = "tutor"
+                self.assertEqual(["hello.txt"], save())
+
+                # Manually modified files are rendered again
+                with open(os.path.join(root_env, "bye.txt"), "w") as f:
+                    f.write("modified")
+                self.assertEqual(["bye.txt"], save())
+                with open(os.path.join(root_env, "bye.txt")) as f:
+                    self.assertEqual("bye world", f.read())
+
+    def test_save_templates_with_render_cache_dynamic_include(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "main.txt"), "w") as f:
+                f.write("{% set name = 'inc.txt' %}{% include name %}")
+            with open(os.path.join(templates_root, "inc.txt"), "w") as f:
+                f.write("P1")
+            renderer = env.Renderer({}, [templates_root])
+            with tempfile.TemporaryDirectory() as root:
+                root_env = env.base_dir(root)
+                render_cache = env.RenderCache(root)
+                env.save_templates(
+                    renderer, ["main.txt"], root_env, render_cache=render_cache
+                )
+                render_cache.save()
+
+                # Edit the included template
+                with open(os.path.join(templates_root, "inc.txt"), "w") as f:
+                    f.write("P2")
+                renderer = env.Renderer({}, [templates_root])
+                render_cache = env.RenderCache(root)
+                env.save_templates(
+                    renderer, ["main.txt"], root_env, render_cache=render_cache
+                )
+                with open(os.path.join(root_env, "main.txt")) as f:
+                    self.assertEqual("P2", f.read())
+
+    def test_template_digest_random_values(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            for name, content in [
+                ("constant.txt", "{{ [1, 2]|first }}"),
+                ("random_string.txt", "{{ 8|random_string }}"),
+                ("random.txt", "{{ [1, 2]|random }}"),
+                ("shuffle.txt", "{{ [1, 2]|shuffle }}"),
+                ("lipsum.txt", "{{ lipsum(1) }}"),
+            ]:
+                with open(os.path.join(templates_root, name), "w") as f:
+                    f.write(content)
+            renderer = env.Renderer({}, [templates_root])
+            self.assertIsNotNone(renderer.template_digest("constant.txt"))
+            self.assertIsNone(renderer.template_digest("random_string.txt"))
+            self.assertIsNone(renderer.template_digest("random.txt"))
+            self.assertIsNone(renderer.template_digest("shuffle.txt"))
+            self.assertIsNone(renderer.template_digest("lipsum.txt"))
+
+    def test_template_digest_random_patches(self):
+        with tempfile.TemporaryDirectory() as templates_root:
+            with open(os.path.join(templates_root, "patched.txt"), "w") as f:
+                f.write('{{ patch("location") }}')
+            for patch in ["{{ 8|random_string }}", "{{ lipsum(1) }}"]:
+                plugin1 = env.plugins.DictPlugin(
+                    {"name": "plugin1", "version": "0", "patches": {"location": patch}}
+                )
+                with unittest.mock.patch.object(
+                    env.plugins, "iter_enabled", return_value=[plugin1],
+                ):
+                    renderer = env.Renderer({}, [templates_root])
+                    self.assertIsNone(renderer.template_digest("patched.txt"))
+
     def test_patch(self):
         patches = {"plugin1": "abcd", "plugin2": "efgh"}
         with unittest.mock.patch.object(
@@ -100,6 +362,30 @@ class EnvTests(unittest.TestCase):
             mock_iter_patches.assert_called_once_with({}, "location")
         self.assertEqual("abcd\nefgh", rendered)
 
+    def test_patch_is_compiled_once(self):
+        patches = {"plugin1": "abcd {{ name }}"}
+        with unittest.mock.patch.object(
+            env.plugins, "iter_patches", return_value=patches.items()
+        ) as mock_iter_patches:
+            renderer = env.Renderer({"name": "world"}, [env.TEMPLATES_ROOT])
+            self.assertEqual("abcd world", renderer.patch("location"))
+            self.assertEqual("abcd world", renderer.patch("location"))
+            mock_iter_patches.assert_called_once_with({"name": "world"}, "location")
+
+    def test_patch_plain_text(self):
+        patches = {"plugin1": "abcd\n", "plugin2": "{{ name }}\n"}
+        with unittest.mock.patch.object(
+            env.plugins, "iter_patches", return_value=patches.items()
+        ):
+            renderer = env.Renderer({"name": "efgh"}, [env.TEMPLATES_ROOT])
+            with unittest.mock.patch.object(
+                renderer.environment,
+                "from_string",
+                wraps=renderer.environment.from_string,
+            ) as mock_from_string:
+                self.assertEqual("abcd\nefgh", renderer.patch("location"))
+        mock_from_string.assert_called_once_with("{{ name }}\n")
+
     def test_patch_separator_suffix(self):
         patches = {"plugin1": "abcd", "plugin2": "efgh"}
         with unittest.mock.patch.object(
@@ -110,6 +396,11 @@ class EnvTests(unittest.TestCase):
             )
         self.assertEqual("abcd,\nefgh,", rendered)
 
+    def test_patch_empty_suffix(self):
+        with unittest.mock.patch.object(env.plugins, "iter_patches", return_value=[]):
+            rendered = env.render_str({}, '{{ patch("location", suffix=",") }}')
+        self.assertEqual("", rendered)
+
     def test_plugin_templates(self):
         with tempfile.TemporaryDirectory() as plugin_templates:
             # Create plugin
@@ -151,6 +442,24 @@ class EnvTests(unittest.TestCase):
                     with open(dst_rendered) as f:
                         self.assertEqual("Hello my ID is abcd", f.read())
 
+    def test_renderer_is_reused_on_config_value_change(self):
+        config = {"name": "world"}
+        renderer1 = env.Renderer.instance(config)
+        config["name"] = "tutor"
+        renderer2 = env.Renderer.instance(config)
+        self.assertIs(renderer1, renderer2)
+        self.assertEqual("hello tutor", renderer2.render_str("hello {{ name }}"))
+
+    def test_iter_enabled_plugins_is_cached(self):
+        plugin1 = env.plugins.DictPlugin({"name": "plugin1", "version": "0"})
+        with unittest.mock.patch.object(
+            env.plugins, "iter_enabled", return_value=[plugin1],
+        ) as mock_iter_enabled:
+            renderer = env.Renderer.instance({"PLUGINS": ["plugin1"]})
+            self.assertEqual([plugin1], list(renderer.iter_enabled_plugins()))
+            self.assertEqual([plugin1], list(renderer.iter_enabled_plugins()))
+            mock_iter_enabled.assert_called_once_with({"PLUGINS": ["plugin1"]})
+
     def test_renderer_is_reset_on_config_change(self):
         with tempfile.TemporaryDirectory() as plugin_templates:
             plugin1 = env.plugins.DictPlugin(
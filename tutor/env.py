@@ -1,8 +1,16 @@
+import bisect
 import codecs
-from copy import deepcopy
+import concurrent.futures
+import filecmp
+import hashlib
+import json
 import os
+import re
 
+import appdirs
 import jinja2
+from jinja2 import meta
+from jinja2 import nodes
 import pkg_resources
 
 from . import exceptions
@@ -15,57 +23,171 @@ from .__about__ import __version__
 TEMPLATES_ROOT = pkg_resources.resource_filename("tutor", "templates")
 VERSION_FILENAME = "version"
 BIN_FILE_EXTENSIONS = [".ico", ".jpg", ".png", ".ttf"]
+BYTECODE_CACHE_ENV_VAR_NAME = "TUTOR_JINJA_BYTECODE_CACHE"
+# Template paths that match this pattern are never rendered: hidden files, compiled
+# python files and __pycache__ folders.
+EXCLUDED_TEMPLATES_PATTERN = r"(^|/)\.[^/]*$|\.pyc$|(^|/)__pycache__$"
+
+# Templates that use these filters or globals must always be rendered again
+NON_CONSTANT_FILTERS = {
+    "encrypt",
+    "random",
+    "random_string",
+    "rsa_private_key",
+    "shuffle",
+}
+NON_CONSTANT_GLOBALS = {"lipsum"}
+
+# Environment versions, indexed by version file path, along with the file mtime
+_current_version_cache = {}
+
+
+try:
+    pass_context = jinja2.pass_context
+except AttributeError:
+    # jinja2<3.0
+    pass_context = jinja2.contextfilter
+
+
+def non_constant(func):
+    """
+    Prevent jinja2 from evaluating a filter with constant arguments at compile time.
+    This is required for filters that generate random values: otherwise, all renders of
+    a compiled "{{ 8|random_string }}" template would produce the same value.
+    """
+
+    def filter_func(_context, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    return pass_context(filter_func)
 
 
 class Renderer:
     INSTANCE = None
+    INSTANCE_PLUGINS = None
 
     @classmethod
     def instance(cls, config):
-        if cls.INSTANCE is None or cls.INSTANCE.config != config:
+        # The environment only depends on the configuration via the template roots of
+        # the enabled plugins: it is re-created only when these plugins change. Other
+        # configuration changes are picked up by storing the config by reference.
+        enabled_plugin_names = list(config.get(plugins.CONFIG_KEY, []))
+        if cls.INSTANCE is None or cls.INSTANCE_PLUGINS != enabled_plugin_names:
             # Load template roots: these are required to be able to use
             # {% include .. %} directives
+            enabled_plugins = list(plugins.iter_enabled(config))
             template_roots = [TEMPLATES_ROOT]
-            for plugin in plugins.iter_enabled(config):
+            for plugin in enabled_plugins:
                 if plugin.templates_root:
                     template_roots.append(plugin.templates_root)
 
             cls.INSTANCE = cls(config, template_roots, ignore_folders=["partials"])
+            cls.INSTANCE._enabled_plugins = enabled_plugins
+            cls.INSTANCE_PLUGINS = enabled_plugin_names
+        cls.INSTANCE.config = config
         return cls.INSTANCE
 
     @classmethod
     def reset(cls):
         cls.INSTANCE = None
+        cls.INSTANCE_PLUGINS = None
 
     def __init__(self, config, template_roots, ignore_folders=None):
-        self.config = deepcopy(config)
+        # Config is stored by reference: it is never modified by the renderer
+        self.config = config
         self.template_roots = template_roots
         self.ignore_folders = ignore_folders or []
         self.ignore_folders.append(".git")
+        self._excluded_templates_re = re.compile(
+            EXCLUDED_TEMPLATES_PATTERN
+            + r"|(^|/)({})(/|$)".format(
+                "|".join(re.escape(folder) for folder in self.ignore_folders)
+            )
+        )
+
+        # Template files are loaded in memory once, such that the filesystem is not
+        # queried every time a template is loaded. Files that could not be pre-loaded
+        # are still served from disk.
+        template_paths = find_template_files(template_roots)
+        loader = jinja2.ChoiceLoader(
+            [
+                jinja2.DictLoader(read_template_sources(template_paths)),
+                jinja2.FileSystemLoader(template_roots),
+            ]
+        )
 
         # Create environment
         environment = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_roots),
+            loader=loader,
             undefined=jinja2.StrictUndefined,
+            bytecode_cache=get_bytecode_cache(),
+            # Templates don't change during the lifetime of a tutor command: compile
+            # each of them at most once.
+            auto_reload=False,
+            cache_size=-1,
         )
         environment.filters["common_domain"] = utils.common_domain
-        environment.filters["encrypt"] = utils.encrypt
+        environment.filters["encrypt"] = non_constant(utils.encrypt)
         environment.filters["list_if"] = utils.list_if
         environment.filters["long_to_base64"] = utils.long_to_base64
-        environment.filters["random_string"] = utils.random_string
+        environment.filters["random_string"] = non_constant(utils.random_string)
         environment.filters["reverse_host"] = utils.reverse_host
-        environment.filters["rsa_private_key"] = utils.rsa_private_key
+        environment.filters["rsa_private_key"] = non_constant(utils.rsa_private_key)
         environment.filters["walk_templates"] = self.walk_templates
         environment.globals["patch"] = self.patch
         environment.globals["rsa_import_key"] = utils.rsa_import_key
         environment.globals["TUTOR_VERSION"] = __version__
         self.environment = environment
+        # Compiled templates for patches and config values, indexed by source text
+        self._string_template_cache = {}
+        # Compiled (plugin, template) patches, indexed by patch name
+        self._patch_cache = {}
+        # Enabled plugins, listed on first use
+        self._enabled_plugins = None
+        # Parsed template dependencies, indexed by template name
+        self._dependencies_cache = {}
+        # Whether plugin patches can be cached, computed on first use
+        self._are_patches_constant = None
+        # Templates that are part of the environment, sorted for fast prefix lookups
+        self._all_templates = sorted(
+            template for template in template_paths if self.is_part_of_env(template)
+        )
 
     def iter_templates_in(self, *path):
         prefix = "/".join(path)
-        for template in self.environment.loader.list_templates():
-            if template.startswith(prefix) and self.is_part_of_env(template):
-                yield template
+        index = bisect.bisect_left(self._all_templates, prefix)
+        while index < len(self._all_templates):
+            template = self._all_templates[index]
+            if not template.startswith(prefix):
+                break
+            yield template
+            index += 1
+
+    def iter_templates_with_prefixes(self, prefixes):
+        """
+        Iterate on the templates that match any of the given prefixes, in a single pass
+        over the environment. Prefixes that end with "/" match all the templates from
+        that folder, while other prefixes match a single template file.
+
+        Yield:
+            (template, prefix): template path along with the matching prefix
+        """
+        folders = tuple(prefix for prefix in prefixes if prefix.endswith("/"))
+        files = set(prefixes) - set(folders)
+        for template in self._all_templates:
+            if template in files:
+                yield template, template
+            elif template.startswith(folders):
+                yield template, next(f for f in folders if template.startswith(f))
+
+    def iter_enabled_plugins(self):
+        """
+        Iterate on the enabled plugins. Plugins are listed just once per renderer, as
+        this requires loading all installed plugins.
+        """
+        if self._enabled_plugins is None:
+            self._enabled_plugins = list(plugins.iter_enabled(self.config))
+        yield from self._enabled_plugins
 
     def walk_templates(self, subdir):
         """
@@ -81,16 +203,7 @@ class Renderer:
         Determines whether a template should be rendered or not. Note that here we don't
         rely on the OS separator, as we are handling templates
         """
-        parts = path.split("/")
-        basename = parts[-1]
-        is_excluded = False
-        is_excluded = (
-            is_excluded or basename.startswith(".") or basename.endswith(".pyc")
-        )
-        is_excluded = is_excluded or basename == "__pycache__"
-        for ignore_folder in self.ignore_folders:
-            is_excluded = is_excluded or ignore_folder in parts
-        return not is_excluded
+        return self._excluded_templates_re.search(path) is None
 
     def find_path(self, path):
         for templates_root in self.template_roots:
@@ -104,8 +217,11 @@ class Renderer:
         Render calls to {{ patch("...") }} in environment templates from plugin patches.
         """
         patches = []
-        for plugin, patch in plugins.iter_patches(self.config, name):
-            patch_template = self.environment.from_string(patch)
+        for plugin, patch_template in self._compile_patches(name):
+            if isinstance(patch_template, str):
+                # Plain text patch: there is nothing to render
+                patches.append(patch_template)
+                continue
             try:
                 patches.append(patch_template.render(**self.config))
             except jinja2.exceptions.UndefinedError as e:
@@ -114,15 +230,49 @@ class Renderer:
                         e.args[0], name, plugin
                     )
                 )
+        if not patches:
+            # Most patches are not implemented by any plugin
+            return ""
         rendered = separator.join(patches)
-        if rendered:
-            rendered += suffix
-        return rendered
+        return rendered + suffix if rendered else rendered
+
+    def _compile_patches(self, name):
+        """
+        Return the compiled (plugin, template) patches for a given patch name. Patches
+        are compiled just once per renderer, as the same patch is usually included by
+        many templates. Patches that do not include any jinja2 syntax are not compiled:
+        their rendered string is returned instead of a template.
+        """
+        if name not in self._patch_cache:
+            patches = []
+            for plugin, patch in plugins.iter_patches(self.config, name):
+                rendered = render_plain_text(patch)
+                if rendered is None:
+                    patches.append((plugin, self._compile_string(patch)))
+                else:
+                    patches.append((plugin, rendered))
+            self._patch_cache[name] = patches
+        return self._patch_cache[name]
 
     def render_str(self, text):
-        template = self.environment.from_string(text)
+        rendered = render_plain_text(text)
+        if rendered is not None:
+            # Most config values are not templates: there is nothing to render
+            return rendered
+        template = self._compile_string(text)
         return self.__render(template)
 
+    def _compile_string(self, source):
+        """
+        Compile a template string. Compiled templates are cached, such that the same
+        patch or config value is parsed only once per renderer.
+        """
+        template = self._string_template_cache.get(source)
+        if template is None:
+            template = self.environment.from_string(source)
+            self._string_template_cache[source] = template
+        return template
+
     def render_file(self, path):
         """
         Render a template file. Return the corresponding string. If it's a binary file
@@ -148,11 +298,157 @@ class Renderer:
             fmt.echo_error("Unknown error rendering template " + path)
             raise
 
+    def stream_file(self, path, dst):
+        """
+        Render a template file to the `dst` path. Rendered content is streamed to disk,
+        such that large templates are never fully loaded in memory. As in `write_to`,
+        files with unchanged content are left untouched.
+        """
+        if is_binary_file(path):
+            write_to(self.render_file(path), dst)
+            return
+
+        try:
+            template = self.environment.get_template(path)
+        except Exception:
+            fmt.echo_error("Error loading template " + path)
+            raise
+
+        utils.ensure_file_directory_exists(dst)
+        tmp_path = dst + ".tmp"
+        try:
+            self.__render_to(template, tmp_path)
+        except (jinja2.exceptions.TemplateError, exceptions.TutorError):
+            fmt.echo_error("Error rendering template " + path)
+            remove_if_exists(tmp_path)
+            raise
+        except Exception:
+            fmt.echo_error("Unknown error rendering template " + path)
+            remove_if_exists(tmp_path)
+            raise
+        replace_if_changed(tmp_path, dst)
+
+    def template_digest(self, path):
+        """
+        Return a digest of all the inputs of a template file: its source, the sources of
+        the templates that it includes and the configuration values that it refers to.
+        Templates that render plugin patches or list other templates depend on the full
+        configuration, on the list of templates and on all plugin patches.
+
+        Return None when the output of the template cannot be predicted from its inputs,
+        for instance when it generates random values or includes templates dynamically.
+        """
+        digest = hashlib.sha1()
+        digest.update(__version__.encode())
+        if is_binary_file(path):
+            with open(self.find_path(path), "rb") as f:
+                digest.update(f.read())
+            return digest.hexdigest()
+
+        # Find sources and variables from the template and all included templates
+        sources = {}
+        variables = set()
+        is_dynamic = False
+        uses_patches = False
+        pending = [path]
+        while pending:
+            template = pending.pop()
+            if template in sources:
+                continue
+            try:
+                dependencies = self._find_dependencies(template)
+            except jinja2.exceptions.TemplateError:
+                # Errors will be reported on render
+                return None
+            source, references, template_variables, filters = dependencies
+            if not filters.isdisjoint(NON_CONSTANT_FILTERS):
+                return None
+            if not template_variables.isdisjoint(NON_CONSTANT_GLOBALS):
+                return None
+            if None in references:
+                # Templates included dynamically cannot be tracked
+                return None
+            if "patch" in template_variables:
+                uses_patches = True
+            if uses_patches or "walk_templates" in filters:
+                is_dynamic = True
+            sources[template] = source
+            pending += [r for r in references if r is not None]
+            variables |= template_variables
+
+        if uses_patches and not self._check_patches_are_constant():
+            return None
+
+        digest.update(json.dumps(sources, sort_keys=True).encode())
+        if is_dynamic:
+            digest.update(
+                json.dumps(
+                    [
+                        self._all_templates,
+                        [[p.name, p.patches] for p in self.iter_enabled_plugins()],
+                    ],
+                    sort_keys=True,
+                    default=str,
+                ).encode()
+            )
+            config = self.config
+        else:
+            config = {key: self.config[key] for key in variables if key in self.config}
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _find_dependencies(self, path):
+        """
+        Parse a template and return its source, the templates that it refers to (None
+        for dynamic references), the variables and the filters that it uses. Variables
+        include globals, such as "patch".
+        """
+        if path not in self._dependencies_cache:
+            source = self.environment.loader.get_source(self.environment, path)[0]
+            self._dependencies_cache[path] = (source,) + self._parse_dependencies(
+                source
+            )
+        return self._dependencies_cache[path]
+
+    def _parse_dependencies(self, source):
+        """
+        Return the templates that a template source refers to, the variables and the
+        filters that it uses.
+        """
+        ast = self.environment.parse(source)
+        return (
+            set(meta.find_referenced_templates(ast)),
+            set(node.name for node in ast.find_all(nodes.Name) if node.ctx == "load"),
+            set(node.name for node in ast.find_all(nodes.Filter)),
+        )
+
+    def _check_patches_are_constant(self):
+        """
+        Return True if the rendered plugin patches depend only on their source and on
+        the configuration: patches must not generate random values, nor include other
+        templates.
+        """
+        if self._are_patches_constant is None:
+            self._are_patches_constant = True
+            for plugin in self.iter_enabled_plugins():
+                for patch in plugin.patches.values():
+                    try:
+                        dependencies = self._parse_dependencies(patch)
+                    except jinja2.exceptions.TemplateError:
+                        dependencies = ({None}, set(), set())
+                    references, variables, filters = dependencies
+                    if (
+                        references
+                        or not filters.isdisjoint(NON_CONSTANT_FILTERS)
+                        or not variables.isdisjoint(NON_CONSTANT_GLOBALS)
+                    ):
+                        self._are_patches_constant = False
+        return self._are_patches_constant
+
     def render_all_to(self, root):
         for template in self.iter_templates_in():
-            rendered = self.render_file(template)
             dst = os.path.join(root, template)
-            write_to(rendered, dst)
+            self.stream_file(template, dst)
 
     def __render(self, template):
         try:
@@ -162,13 +458,78 @@ class Renderer:
                 "Missing configuration value: {}".format(e.args[0])
             )
 
+    def __render_to(self, template, path):
+        try:
+            template.stream(**self.config).dump(path, encoding="utf-8")
+        except jinja2.exceptions.UndefinedError as e:
+            raise exceptions.TutorError(
+                "Missing configuration value: {}".format(e.args[0])
+            )
+
+
+def find_template_files(template_roots):
+    """
+    Return the absolute paths of all files from the template roots, indexed by template
+    name. As with jinja2.FileSystemLoader, templates from the first roots take
+    precedence.
+    """
+    template_paths = {}
+    for templates_root in template_roots:
+        for dirpath, dirnames, filenames in os.walk(templates_root):
+            # Skip folders that never contain templates
+            dirnames[:] = [d for d in dirnames if d not in [".git", "__pycache__"]]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                template = os.path.relpath(path, templates_root).replace(os.sep, "/")
+                template_paths.setdefault(template, path)
+    return template_paths
+
+
+def read_template_sources(template_paths):
+    """
+    Return the contents of text templates, indexed by template name. Binary files are
+    skipped, as well as files that cannot be read: these are left to the
+    jinja2.FileSystemLoader.
+    """
+    sources = {}
+    for template, path in template_paths.items():
+        if is_binary_file(template):
+            continue
+        try:
+            with codecs.open(path, encoding="utf-8") as f:
+                sources[template] = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+    return sources
+
+
+def get_bytecode_cache():
+    """
+    Return a bytecode cache to store compiled templates across tutor invocations, or
+    None if this cache was disabled by setting TUTOR_JINJA_BYTECODE_CACHE=0. Cached
+    bytecode is stored per tutor version, such that upgrades never load stale files.
+    """
+    if os.environ.get(BYTECODE_CACHE_ENV_VAR_NAME) == "0":
+        return None
+    cache_dir = os.path.join(
+        appdirs.user_cache_dir(appname="tutor"), "jinja2-bytecode", __version__
+    )
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        # Caching is not worth failing for, e.g: in read-only home directories
+        return None
+    return jinja2.FileSystemBytecodeCache(
+        directory=cache_dir, pattern="__jinja2_%s.cache"
+    )
+
 
 def save(root, config):
     """
     Save the full environment, including version information.
     """
     root_env = pathjoin(root)
-    for prefix in [
+    prefixes = (
         "android/",
         "apps/",
         "build/",
@@ -178,13 +539,19 @@ def save(root, config):
         "webui/",
         VERSION_FILENAME,
         "kustomization.yml",
-    ]:
-        save_all_from(prefix, root_env, config)
+    )
+    renderer = Renderer.instance(config)
+    render_cache = RenderCache(root)
+    templates = [
+        template for template, _ in renderer.iter_templates_with_prefixes(prefixes)
+    ]
+    save_templates(renderer, templates, root_env, render_cache=render_cache)
 
-    for plugin in plugins.iter_enabled(config):
+    for plugin in renderer.iter_enabled_plugins():
         if plugin.templates_root:
-            save_plugin_templates(plugin, root, config)
+            save_plugin_templates(plugin, root, config, render_cache=render_cache)
 
+    render_cache.save()
     upgrade_obsolete(root)
     fmt.echo_info("Environment generated in {}".format(base_dir(root)))
 
@@ -197,7 +564,7 @@ def upgrade_obsolete(root):
         os.remove(nginx_tutor_conf)
 
 
-def save_plugin_templates(plugin, root, config):
+def save_plugin_templates(plugin, root, config, render_cache=None):
     """
     Save plugin templates to plugins/<plugin name>/*.
     Only the "apps" and "build" subfolders are rendered.
@@ -205,31 +572,144 @@ def save_plugin_templates(plugin, root, config):
     plugins_root = pathjoin(root, "plugins")
     for subdir in ["apps", "build"]:
         subdir_path = os.path.join(plugin.name, subdir)
-        save_all_from(subdir_path, plugins_root, config)
+        save_all_from(subdir_path, plugins_root, config, render_cache=render_cache)
 
 
-def save_all_from(prefix, root, config):
+def save_all_from(prefix, root, config, render_cache=None):
     """
     Render the templates that start with `prefix` and store them with the same
     hierarchy at `root`.
     """
     renderer = Renderer.instance(config)
-    for template in renderer.iter_templates_in(prefix):
-        rendered = renderer.render_file(template)
+    save_templates(
+        renderer, renderer.iter_templates_in(prefix), root, render_cache=render_cache
+    )
+
+
+def save_templates(renderer, templates, root, render_cache=None):
+    """
+    Render templates and store them with the same hierarchy at `root`. Templates are
+    rendered concurrently, as they are all independent from one another. If a render
+    cache is given, templates whose inputs did not change since they were last saved
+    are not rendered again.
+    """
+    templates = list(templates)
+    # Create parent directories beforehand, such that workers don't compete to create
+    # them
+    for directory in set(os.path.dirname(os.path.join(root, t)) for t in templates):
+        os.makedirs(directory, exist_ok=True)
+
+    def save_template(template):
         dst = os.path.join(root, template)
-        write_to(rendered, dst)
+        if render_cache is None:
+            renderer.stream_file(template, dst)
+            return
+        digest = renderer.template_digest(template)
+        if digest is not None and render_cache.is_fresh(dst, digest):
+            return
+        renderer.stream_file(template, dst)
+        render_cache.update(dst, digest)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Consume results to re-raise rendering errors
+        list(executor.map(save_template, templates))
+
+
+class RenderCache:
+    """
+    Keep track of the inputs of the files from the environment, such that templates are
+    rendered again only when their inputs change. Files that were modified since they
+    were rendered are also rendered again.
+
+    Entries are stored in env/.render_cache.json as:
+
+        {"<path relative to env/>": ["<inputs digest>", <mtime_ns>, <size>]}
+    """
+
+    FILENAME = ".render_cache.json"
+
+    def __init__(self, root):
+        self.root = base_dir(root)
+        self.path = os.path.join(self.root, self.FILENAME)
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def is_fresh(self, path, digest):
+        """
+        Return True if the file at `path` was rendered from the same inputs and was not
+        modified since.
+        """
+        entry = self.entries.get(os.path.relpath(path, self.root))
+        if entry is None or entry[0] != digest:
+            return False
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return entry[1:] == [stat.st_mtime_ns, stat.st_size]
+
+    def update(self, path, digest):
+        key = os.path.relpath(path, self.root)
+        if digest is None:
+            self.entries.pop(key, None)
+            return
+        stat = os.stat(path)
+        self.entries[key] = [digest, stat.st_mtime_ns, stat.st_size]
+
+    def save(self):
+        write_to(json.dumps(self.entries, indent=0, sort_keys=True), self.path)
 
 
 def write_to(content, path):
     """
     Write some content to a path. Content can be either str or bytes.
+
+    Files that already have the same content are left untouched. Otherwise, content is
+    written to a temporary file which then replaces the destination, such that an
+    interrupted write never leaves a truncated file behind.
     """
     open_mode = "w"
     if isinstance(content, bytes):
         open_mode += "b"
+    if is_unchanged(content, path):
+        return
     utils.ensure_file_directory_exists(path)
-    with open(path, open_mode) as of:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, open_mode) as of:
         of.write(content)
+    os.replace(tmp_path, path)
+
+
+def replace_if_changed(src, dst):
+    """
+    Move the `src` file to `dst`, unless `dst` already has the same content: in that
+    case, `src` is simply removed.
+    """
+    if os.path.exists(dst) and filecmp.cmp(src, dst, shallow=False):
+        os.remove(src)
+    else:
+        os.replace(src, dst)
+
+
+def remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def is_unchanged(content, path):
+    """
+    Return True if the file at `path` exists and has the same content.
+    """
+    open_mode = "rb" if isinstance(content, bytes) else "r"
+    try:
+        with open(path, open_mode) as f:
+            return f.read() == content
+    except (OSError, UnicodeDecodeError):
+        return False
 
 
 def render_file(config, *path):
@@ -246,17 +726,16 @@ def render_dict(config):
     Render the values from the dict. This is useful for rendering the default
     values from config.yml.
 
+    Values are rendered in place, in insertion order: values that reference other
+    entries see the rendered values of the entries that come before them.
+
     Args:
         config (dict)
     """
-    rendered = {}
+    renderer = Renderer.instance(config)
     for key, value in config.items():
         if isinstance(value, str):
-            rendered[key] = render_str(config, value)
-        else:
-            rendered[key] = value
-    for k, v in rendered.items():
-        config[k] = v
+            config[key] = renderer.render_str(value)
 
 
 def render_unknown(config, value):
@@ -322,9 +801,17 @@ def current_version(root):
     return "0.0.0".
     """
     path = pathjoin(root, VERSION_FILENAME)
-    if not os.path.exists(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
         return "0.0.0"
-    return open(path).read().strip()
+    cached = _current_version_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        version = f.read().strip()
+    _current_version_cache[path] = (mtime, version)
+    return version
 
 
 def read_template_file(*path):
@@ -336,6 +823,18 @@ def read_template_file(*path):
         return fi.read()
 
 
+def render_plain_text(text):
+    """
+    Return the text as it would be rendered by jinja2, provided that it contains no
+    jinja2 syntax: as with jinja2, a single trailing newline is stripped. Return None
+    for texts that need to be rendered by jinja2, including texts with carriage returns,
+    which jinja2 normalizes.
+    """
+    if "{" in text or "\r" in text:
+        return None
+    return text[:-1] if text.endswith("\n") else text
+
+
 def is_binary_file(path):
     ext = os.path.splitext(path)[1]
     return ext in BIN_FILE_EXTENSIONS